@@ -1,11 +1,73 @@
+import collections
 import doctest
+import functools
 import re
-from typing import Union, Dict, List, Tuple
+import sys
+from typing import Union, Dict, Iterable, Iterator, List, Optional, Tuple
 
 PatternSpec = Union[str, Tuple[str, str]]
 Path = str
 
 
+def _require_prefix(path: Path, sep: str) -> None:
+    if not path.startswith(sep):
+        raise ValueError(f"{path=} should start with '{sep}' when self.absolute=True")
+
+
+def _forbid_prefix(path: Path, sep: str) -> None:
+    if path.startswith(sep):
+        raise ValueError(f"{path=} should not start with '{sep}' when self.absolute=False")
+
+
+def _load_engine(engine: str):
+    """ regex module used to compile the key pattern, "regex" only adds (?>...) before 3.11 """
+    if engine == "re":
+        return re
+    elif engine == "regex":
+        try:
+            import regex  # optional third-party engine
+        except ImportError as e:
+            raise ImportError(f"{engine=} requires the 'regex' package: pip install regex") from e
+        return regex
+    else:
+        raise ValueError(f"Invalid argument {engine=}, must be either 're' or 'regex'")
+
+
+def _literal(expr: str) -> Optional[str]:
+    """ the only text the regex expr can match (e.g. "\\.csv\\.gz"), or None """
+    text, escaped = [], False
+    for c in expr:
+        if escaped:
+            if c.isalnum():  # a class or backreference such as \d or \1
+                return None
+            text.append(c)
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c in ".^$*+?{}[]|()":
+            return None
+        else:
+            text.append(c)
+    return None if escaped else "".join(text)
+
+
+def _freeze_specs(specs):
+    """ copy of a list of PatternSpecs with every (nested) list made a tuple """
+    if type(specs) not in (list, tuple):
+        return specs  # not a spec list, left for KeyParser.__init__ to reject
+    frozen = []
+    for s in specs:
+        if type(s) == tuple and len(s) == 2 and type(s[1]) in (list, tuple):
+            s = (s[0], _freeze_specs(s[1]))
+        frozen.append(s)
+    return tuple(frozen)
+
+
+@functools.lru_cache(maxsize=256)
+def _cached_parser(cls, kwargs: Tuple[Tuple[str, object], ...]):
+    return cls(**dict(kwargs))
+
+
 class KeyParser:
     """ Parses keys using regex with increasing sophistication.
     regex matches against the entire key.
@@ -100,6 +162,75 @@ class KeyParser:
     ... ).parse("12/3/4=56/7.8.gz")
     {'dir1': '12', 'one': '1', 'two': '2', 'dir2': '3', 'key': '56', 'five': '5', 'six': '6', 'file': '7.8', 'seven': '7', 'eight': '8', 'ext': '.gz'}
 
+    **Options**
+
+    The separator is matched literally, so regex metacharacters are fine,
+    and absolute keys put it at the front of the pattern:
+
+    >>> parser = KeyParser(dirs=['one'], file=['two'], absolute=True, separator='|')
+    >>> parser.parse("|1|2.csv")
+    {'one': '1', 'two': '2.csv'}
+    >>> parser.pattern_str.startswith(re.escape('|'))
+    True
+
+    Names never swallow a separator, even one made of word characters:
+
+    >>> KeyParser(dirs=['city'], file=['rest'], separator='_', strict=False).parse("a_b_c.csv")
+    {'city': 'a', 'rest': 'b_c.csv'}
+
+    Only the whole separator is excluded, so names may contain part of it:
+
+    >>> KeyParser(dirs=['d'], file=['f'], separator='__').parse("my_dir__x.csv")
+    {'d': 'my_dir', 'f': 'x.csv'}
+
+    Separators inside partition names are part of the name, not the value:
+
+    >>> KeyParser(partitions=['my_part'], file=['f'], separator='_').parse("my_part=1_x.csv")
+    {'my_part': '1', 'f': 'x.csv'}
+
+    The default regexes only accept ASCII word characters; turn off
+    ascii_only for keys with non-ASCII names:
+
+    >>> KeyParser(dirs=['city'], file=['f'], ascii_only=False).parse("Zürich/f.csv")
+    {'city': 'Zürich', 'f': 'f.csv'}
+
+    When no group has to give characters back to the next one, atomic
+    groups stop failed matches from backtracking:
+
+    >>> KeyParser(dirs=['one'], file=[('base', '[^.]+'), ('ext', '.+')], atomic=True).parse("a/file.tar.gz")
+    {'one': 'a', 'base': 'file', 'ext': '.tar.gz'}
+
+    Building a parser compiles a regex. When the same configuration is
+    rebuilt in a loop, KeyParser.get returns a cached parser instead:
+
+    >>> KeyParser.get(dirs=['one'], file=['two']) is KeyParser.get(dirs=['one'], file=['two'])
+    True
+
+    Batches of keys can be parsed in one call:
+
+    >>> KeyParser(dirs=['one'], file=['two']).parse_many(["a/1.csv", "b/2.csv"])
+    [{'one': 'a', 'two': '1.csv'}, {'one': 'b', 'two': '2.csv'}]
+
+    When a group has only a handful of distinct values, intern_keys makes
+    every parse share the same string for each of them:
+
+    >>> a, b = KeyParser(dirs=['env'], file=['f'], intern_keys=['env']).parse_many(["dev/1.csv", "dev/2.csv"])
+    >>> a['env'] is b['env']
+    True
+
+    parse_tuple returns a namedtuple, which takes less memory than a dict
+    (120 vs 272 bytes for the realistic example above):
+
+    >>> parser = KeyParser(dirs=['one'], file=['two'])
+    >>> parser.parse_tuple("a/1.csv")
+    KeyParseResult(one='a', two='1.csv')
+
+    The results can't be pickled, but the parser can, e.g. for worker processes:
+
+    >>> import pickle
+    >>> pickle.loads(pickle.dumps(parser)).parse("a/1.csv")
+    {'one': 'a', 'two': '1.csv'}
+
     **Exceptions**
 
     An exception is raised if any of the keys is used more than once:
@@ -116,6 +247,13 @@ class KeyParser:
     ...
     ValueError: Parsed values contain the separator '/': {'a': 'a/b.csv'}
 
+    or if you try to change a parser once it is built:
+
+    >>> KeyParser(file=['a']).sep = "."
+    Traceback (most recent call last):
+    ...
+    AttributeError: KeyParser is immutable, can't set 'sep'
+
     or if the key is an invalid identifier:
 
     >>> KeyParser(file=['1']).parse("b.csv")
@@ -147,7 +285,11 @@ class KeyParser:
                  file: List[PatternSpec] = None,
                  absolute: bool = False,
                  separator: str = "/",
-                 strict: bool = True):
+                 strict: bool = True,
+                 engine: str = "re",
+                 ascii_only: bool = True,
+                 intern_keys: Iterable[str] = None,
+                 atomic: bool = False):
         """ parses keys to form named groups. Groups starting with '_' are removed
         :param dirs: list of Patterns in either group_name or (group_name, regex) format
         :param partitions: list of Patterns in either group_name or (group_name, regex) format
@@ -155,68 +297,173 @@ class KeyParser:
         :param absolute: Does the key start with the separator?
         :param separator: The character to use as the separator
         :param strict: disable strict mode to turn off checking the parsed values for the separator.
+        :param engine: "re", or "regex" to compile with the third-party regex module.
+            Only for atomic=True before Python 3.11: parse is about 3x slower with "regex".
+        :param ascii_only: match \\w and friends against ASCII only, which is faster.
+            Disable it if keys contain non-ASCII names.
+        :param intern_keys: group names whose values repeat a lot (e.g. environment), these
+            values are sys.intern'ed so repeated parses share one string.
+        :param atomic: make every group atomic, so a failed match never backtracks into it.
+            Only correct if no group needs to give characters back to the one after it.
+            Needs Python 3.11+ or engine="regex".
         """
-        self.dirs = dirs
-        self.partitions = partitions
-        self.file = file
-        self.absolute = absolute
-        self.sep = separator
-        self.strict = strict
-
         # Guards:
-        if self.dirs is None: self.dirs = []
-        if self.partitions is None: self.partitions = []  # Optional arg
-        if self.file is None: raise ValueError(f"file must not be empty, got {file}")
-        if not isinstance(self.file, list): raise ValueError(
+        if dirs is None: dirs = []
+        if partitions is None: partitions = []  # Optional arg
+        if file is None: raise ValueError(f"file must not be empty, got {file}")
+        if not isinstance(file, (list, tuple)): raise ValueError(
             f"file must be a list, got {repr(file)}")
 
+        # State is written to __dict__ directly: __setattr__ forbids changes, and
+        # going through it for every attribute made construction much slower.
+        # Specs are stored as tuples, nested ones too, so a parser can be shared.
+        dirs, partitions, file = _freeze_specs(dirs), _freeze_specs(partitions), _freeze_specs(file)
+        sep = separator
+
+        # Default for bare dir/partition names. It must not match the separator,
+        # or a failed match backtracks over every split point; "\w" already
+        # can't, unless the separator contains word characters (e.g. "_").
+        if not any(c.isalnum() or c == "_" for c in sep):
+            word_regex = r"\w+"
+        elif len(sep) == 1:
+            word_regex = rf"[^\W{re.escape(sep)}]+"
+        else:  # e.g. "__": names may still contain a single "_"
+            word_regex = rf"(?:(?!{re.escape(sep)})\w)+"
+
         # Derived Properties
-        self.path_prefix = self.sep if absolute else ""
-        self.path_type = "absolute" if absolute else "relative"  # for logging
+        self.__dict__.update(
+            dirs=dirs, partitions=partitions, file=file, absolute=absolute, sep=sep,
+            strict=strict, engine=engine, ascii_only=ascii_only, atomic=atomic,
+            path_prefix=sep if absolute else "",
+            path_type="absolute" if absolute else "relative",  # for logging
+            _check_prefix=_require_prefix if absolute else _forbid_prefix,
+            _word_regex=word_regex)
 
         # Keep final re as string for debugging/logging
-        self.pattern_str = self._build_path_pattern(
-            dirs=self.dirs,
-            partitions=self.partitions,
-            files=self.file,  # file may have multiple parts
-            separator=self.sep)
+        pattern_str = self._build_path_pattern(
+            dirs=dirs,
+            partitions=partitions,
+            files=file,  # file may have multiple parts
+            separator=sep)
 
         # Compile for reuse
-        self.path_pattern = re.compile(self.pattern_str)
-
-    def _make_partition(self, p: PatternSpec) -> str:
-        if type(p) == str:
-            return f"{p}=(?P<{p}>\w+)"
-        elif type(p) == tuple and len(p) == 2:
-            key, expr = p
-            if type(expr) == list:
-                l_expr = "".join(self._make_dir(q) for q in expr)
-                return f"{key}=(?P<key>{l_expr})"
-            elif type(expr) == str:
-                return f"{key}=(?P<{key}>{expr})"
-            else:
-                raise ValueError(
-                    f"Invalid argument {expr=}, must pass either partition name or (partition name, regex)")
-        else:
-            raise ValueError(
-                f"Invalid argument {p=}, must pass either partition name or (partition name, regex)")
-
-    def _make_file(self, f: PatternSpec):
-        if type(f) == str:  # group name
-            return f"(?P<{f}>[\w+\.]+)"
-        elif type(f) == tuple and len(f) == 2:  # single group
-            key, expr = f
-            if type(expr) == list:
-                l_expr = "".join(self._make_dir(q) for q in expr)
-                return f"(?P<{key}>{l_expr})"
-            elif type(expr) == str:
-                return f"(?P<{key}>{expr})"
-            else:
+        re_engine = _load_engine(engine)
+        path_pattern = re_engine.compile(pattern_str, re_engine.ASCII if ascii_only else 0)
+
+        # Names returned by parse. "_" specs are already non-capturing, but a
+        # custom regex may still contain its own (?P<_name>...) group.
+        keep_keys = tuple(n for n in path_pattern.groupindex if not n.startswith("_"))
+        # m.groupdict() beats {k: m[k] for k in keys}, but only when it is the whole result.
+        groupdict_is_result = len(keep_keys) == len(path_pattern.groupindex)
+
+        # A match consumes exactly this many literal separators: the absolute
+        # prefix, one between segments and any inside partition "name=" prefixes.
+        # Any extra ones in the key must have been captured into a value.
+        expected_sep_count = (int(absolute) + len(dirs) + len(partitions)
+                              + sum(f"{self._partition_name(p)}=".count(sep)
+                                    for p in partitions))
+
+        # Shorter keys can't match, so parse rejects them without running the regex.
+        min_len = (len(self.path_prefix) + len(sep) * (len(dirs) + len(partitions))
+                   + sum(map(self._min_spec_len, [*dirs, *file]))
+                   + sum(len(self._partition_name(p)) + 1 + self._min_spec_len(p)
+                         for p in partitions))
+
+        if isinstance(intern_keys, str):
+            intern_keys = (intern_keys,)  # a single name, not its characters
+        intern_keys = tuple(intern_keys or ())
+        if unknown := set(intern_keys).difference(keep_keys):
+            raise ValueError(f"intern_keys must be parsed group names, got {unknown}")
+
+        self.__dict__.update(
+            pattern_str=pattern_str,
+            path_pattern=path_pattern,
+            _keep_keys=keep_keys,
+            _groupdict_is_result=groupdict_is_result,
+            _strict_sep_count=expected_sep_count if strict else None,
+            _min_len=min_len,
+            _intern_keys=intern_keys,
+            # parse can return m.groupdict() as is, see _groups for the other cases.
+            _plain_groupdict=groupdict_is_result and not intern_keys,
+            _frozen=True)  # see __setattr__
+
+    @functools.cached_property
+    def _Result(self) -> type:
+        # Built on first use: namedtuple() costs more than the rest of __init__.
+        return collections.namedtuple("KeyParseResult", self._keep_keys, rename=True)
+
+    def __getstate__(self):
+        # _Result is made at runtime, so pickle can't find it; it is rebuilt on demand.
+        state = self.__dict__.copy()
+        state.pop("_Result", None)
+        return state
+
+    def __setattr__(self, name, value):
+        # Parsers are shared (e.g. by KeyParser.get), so they can't change once built.
+        if getattr(self, "_frozen", False):
+            raise AttributeError(f"KeyParser is immutable, can't set {name!r}")
+        super().__setattr__(name, value)
+
+    def __delattr__(self, name):
+        if getattr(self, "_frozen", False):
+            raise AttributeError(f"KeyParser is immutable, can't delete {name!r}")
+        super().__delattr__(name)
+
+    @classmethod
+    def get(cls, **kwargs) -> "KeyParser":
+        """ like KeyParser(**kwargs), but returns a shared parser for repeated configurations.
+        Use this in hot loops; the most recent 256 configurations are kept.
+        """
+        # Make the unhashable arguments hashable, the rest go to __init__ as is.
+        for spec_arg in ("dirs", "partitions", "file"):
+            if spec_arg in kwargs:
+                kwargs[spec_arg] = _freeze_specs(kwargs[spec_arg])
+        intern_keys = kwargs.get("intern_keys")
+        if isinstance(intern_keys, str):
+            kwargs["intern_keys"] = (intern_keys,)
+        elif intern_keys is not None:
+            kwargs["intern_keys"] = tuple(sorted(intern_keys))
+        try:
+            return _cached_parser(cls, tuple(sorted(kwargs.items())))
+        except TypeError:  # still unhashable, e.g. a malformed spec; let __init__ report it
+            return cls(**kwargs)
+
+    def _emit(self, spec: PatternSpec, default: str) -> str:
+        """ group for spec, bare group names match the default regex """
+        if type(spec) == str:
+            name, expr = spec, default
+        elif type(spec) == tuple and len(spec) == 2:
+            name, expr = spec
+            if type(expr) in (list, tuple):
+                word = self._word_regex
+                expr = "".join([self._emit(q, word) for q in expr])
+            elif type(expr) != str:
                 raise ValueError(
-                    f"Invalid argument {expr}, must pass either regex or List[PatternSpec]")
+                    f"Invalid argument {expr=}, must pass either regex or List[PatternSpec]")
         else:
-            raise ValueError(
-                f"Invalid argument {f=}, must pass one of:\nfilename, (filename, regex) or List(filename_part, part_regex)")
+            raise ValueError(f"Invalid argument {spec=}, must pass either group_name or (group_name, regex)")
+
+        # Groups starting with "_" are never returned, so don't capture them.
+        if name.startswith("_"):
+            return f"(?>{expr})" if self.atomic else f"(?:{expr})"
+        if self.atomic:
+            expr = f"(?>{expr})"
+        return f"(?P<{name}>{expr})"
+
+    def _make_partition(self, p: PatternSpec) -> str:
+        if type(p) == tuple and len(p) == 2 and type(p[1]) in (list, tuple):
+            # Nested partitions capture the whole value as "key".
+            return f"{p[0]}=" + self._emit(("key", p[1]), self._word_regex)
+        group = self._emit(p, self._word_regex)
+        return f"{self._partition_name(p)}={group}"
+
+    @staticmethod
+    def _partition_name(p: PatternSpec) -> str:
+        """ the literal name in front of a partition's "=" """
+        return p if type(p) == str else p[0]
+
+    def _make_file(self, f: PatternSpec) -> str:
+        return self._emit(f, r"[\w+\.]+")
 
     def _build_path_pattern(self, dirs: List[PatternSpec], partitions: List[PatternSpec],
                             files: List[PatternSpec], separator: str) -> str:
@@ -225,46 +472,87 @@ class KeyParser:
         partition_patterns = [self._make_partition(p) for p in partitions]
         file_pattern = [self._make_file(f) for f in files]
 
-        dir_parts = [*dirs_patterns, *partition_patterns]
-        directories_pattern = separator.join(dir_parts) + (separator if dir_parts else "")
-
-        path_pattern = self.path_prefix + directories_pattern + "".join(file_pattern)
+        # One join over every segment, so the separator is only emitted between
+        # segments and the (escaped) absolute prefix stays a leading literal.
+        segments = [*dirs_patterns, *partition_patterns, "".join(file_pattern)]
+        path_pattern = re.escape(self.path_prefix) + re.escape(separator).join(segments)
         return path_pattern
 
     def _make_dir(self, layer: PatternSpec) -> str:
-        if type(layer) == str:
-            return f"(?P<{layer}>\w+)"
-        elif type(layer) == tuple and len(layer) == 2:
-            k, expr = layer
-            if type(expr) == list:
-                l_expr = "".join(self._make_dir(q) for q in expr)
-                return f"(?P<{k}>{l_expr})"
-            elif type(expr) == str:
-                return f"(?P<{k}>{expr})"
-            else:
-                raise ValueError(
-                    f"Invalid argument {layer=}, must pass either dir_name name or List[PatternSpec]")
+        return self._emit(layer, self._word_regex)
+
+    def _min_spec_len(self, spec: PatternSpec) -> int:
+        """ lower bound on the length of the text a (valid) spec's group matches """
+        if type(spec) == str:
+            return 1  # the default regexes are all "+" repeats
+        _, expr = spec
+        if type(expr) == str:
+            literal = _literal(expr)
+            return 0 if literal is None else len(literal)  # 0 is safe for any other regex
+        return sum(map(self._min_spec_len, expr))
+
+    def _groups(self, m) -> Dict[str, str]:
+        """ parse result for a match when m.groupdict() alone won't do """
+        if self._groupdict_is_result:
+            groups = m.groupdict()
         else:
-            raise ValueError(f"Invalid argument {layer=}")
+            groups = {k: m[k] for k in self._keep_keys}
+        for k in self._intern_keys:
+            if (v := groups[k]) is not None:  # optional groups may not match
+                groups[k] = sys.intern(v)
+        return groups
 
     def parse(self, path: Path) -> Dict[str, str]:
-        if self.absolute and not path.startswith(self.sep):
-            raise ValueError(f"{path=} should start with '{self.sep}' when {self.absolute=}")
-        elif not self.absolute and path.startswith(self.sep):
-            raise ValueError(f"{path=} should not start with '{self.sep}' when {self.absolute=}")
-
-        if m := re.fullmatch(self.path_pattern, path):
-            groups = m.groupdict()
-            if self.strict and any(self.sep in val for val in groups.values()):
+        sep, strict_sep_count = self.sep, self._strict_sep_count
+        self._check_prefix(path, sep)
+
+        # Even for keys made only of bare names, str.split plus validating each
+        # part (str.partition for key=value partitions) was measured slower
+        # than fullmatch + groupdict, so always match.
+        if len(path) >= self._min_len and (m := self.path_pattern.fullmatch(path)):
+            groups = m.groupdict() if self._plain_groupdict else self._groups(m)
+            if strict_sep_count is not None and path.count(sep) != strict_sep_count:
                 raise ValueError(
-                    f"Parsed values contain the separator '{self.sep}': {groups}")
-            # Filter out groups stating with "_"
-            r_groups = {k: v for k, v in groups.items() if not k.startswith("_")}
-            return r_groups
+                    f"Parsed values contain the separator '{sep}': {groups}")
+            return groups
         else:
             pattern = self.pattern_str  # Use uncompiled version for exception.
             raise ValueError(f"{path=} did not match {self.path_type} path: \n{pattern=}")
 
+    def parse_tuple(self, path: Path) -> Tuple[str, ...]:
+        """ like parse, but returns a KeyParseResult namedtuple instead of a dict.
+        KeyParseResult classes are made per parser, so results can't be pickled.
+        """
+        sep = self.sep
+        self._check_prefix(path, sep)
+
+        keep = self._keep_keys
+        m = self.path_pattern.fullmatch(path) if len(path) >= self._min_len else None
+        strict_sep_count = self._strict_sep_count
+        if (m is None or (strict_sep_count is not None and path.count(sep) != strict_sep_count)
+                or self._intern_keys or len(keep) < 2):
+            # raises the appropriate error, or handles the uncommon cases
+            return self._Result._make(self.parse(path).values())
+        return self._Result._make(m.group(*keep))
+
+    def parse_many(self, paths: Iterable[Path]) -> List[Dict[str, str]]:
+        """ parse every path, equivalent to [self.parse(p) for p in paths] """
+        return list(self.parse_many_iter(paths))
+
+    def parse_many_iter(self, paths: Iterable[Path]) -> Iterator[Dict[str, str]]:
+        """ lazy version of parse_many """
+        fullmatch, sep, absolute = self.path_pattern.fullmatch, self.sep, bool(self.absolute)
+        strict_sep_count, min_len = self._strict_sep_count, self._min_len
+        plain_groupdict, groups_of = self._plain_groupdict, self._groups
+
+        for path in paths:
+            m = fullmatch(path) if len(path) >= min_len else None
+            if (m is None or path.startswith(sep) != absolute
+                    or (strict_sep_count is not None and path.count(sep) != strict_sep_count)):
+                yield self.parse(path)  # raises the appropriate error
+                continue
+            yield m.groupdict() if plain_groupdict else groups_of(m)
+
 
 if __name__ == '__main__':
     # Run the doctests.